@@ -4,10 +4,18 @@ import altair as alt
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 import uuid
+import os
+import math
+import threading
 
 USERS_FILE = "users.csv"
 DATA_FILE = "water_usage.csv"
 
+# Giới hạn số điểm / số cột mỗi biểu đồ để payload gửi lên trình duyệt luôn nhỏ
+MAX_CHART_POINTS = 60
+MAX_CHART_CATEGORIES = 12
+GROUP_LOG_PAGE_SIZE = 50
+
 # ----------------- Utils thời gian -----------------
 def now_vietnam():
     """
@@ -294,11 +302,12 @@ def explode_and_allocate(df, activity_col='activity', amount_col='amount'):
     df['alloc_amount'] = df[amount_col].astype(float) / counts.replace(0,1)
     return df
 
-def save_or_merge_entry(data, username, house_type, location, addr_input, activity, amount, note_text, date_input):
+def save_or_merge_entry(data, username, house_type, location, addr_input, activity, amount, note_text, date_input, detector=None, daily_limit=None):
     """
     Save 1 activity as a separate row. If the user's last activity is within 30 minutes,
     reuse that last row's group_id (so activities share the same group).
     This function localizes user_entries datetimes to VN tz to avoid tz-aware/tz-naive subtraction errors.
+    If a UsageAnomalyDetector is given, the new entry is also fed into it (incremental baseline update).
     """
     now = now_vietnam()
     # ensure columns
@@ -348,8 +357,333 @@ def save_or_merge_entry(data, username, house_type, location, addr_input, activi
         "group_id": group_id
     }
     data = pd.concat([data, pd.DataFrame([new_entry])], ignore_index=True)
+    if detector is not None:
+        same_day = data[(data['username']==username) & (data['date'].astype(str).str[:10]==new_entry['date'][:10])]
+        day_total = float(pd.to_numeric(same_day['amount'], errors='coerce').fillna(0.0).sum())
+        detector.update(new_entry, daily_limit, day_total=day_total)
     return data
 
+# ----------------- Chart data service -----------------
+# resolution -> (mã Period của pandas, nhãn hiển thị, số ngày xấp xỉ mỗi điểm)
+CHART_RESOLUTIONS = {
+    "day": ("D", "Ngày", 1),
+    "week": ("W", "Tuần", 7),
+    "month": ("M", "Tháng", 30),
+    "year": ("Y", "Năm", 365),
+}
+
+def pick_chart_resolution(start_date, end_date, max_points=MAX_CHART_POINTS):
+    """
+    Chọn độ phân giải mịn nhất (ngày/tuần/tháng/năm) sao cho khoảng ngày đã chọn
+    không vượt quá max_points điểm trên biểu đồ.
+    """
+    span_days = max((end_date - start_date).days + 1, 1)
+    for resolution, (_, _, days) in CHART_RESOLUTIONS.items():
+        # +1 vì khoảng ngày có thể cắt ngang 2 kỳ ở hai đầu
+        if span_days // days + 1 <= max_points:
+            return resolution
+    return "year"
+
+def data_version():
+    """
+    Phiên bản dữ liệu = (mtime_ns, size) của DATA_FILE. Đưa vào key cache để mọi lần save_data()
+    đều làm mới kết quả đã cache (kể cả trên filesystem chỉ lưu mtime theo giây).
+    """
+    try:
+        stat = os.stat(DATA_FILE)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return (0, 0)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def get_user_frame(_data, username, version):
+    """
+    Dữ liệu của 1 user (các cột gốc giữ nguyên) + 2 cột phụ để gom nhóm:
+    '_day' (datetime, NaT nếu ngày không hợp lệ) và '_amount' (số, 0 nếu không hợp lệ).
+    Cache theo (user, phiên bản dữ liệu); `_data` là DataFrame dashboard đã đọc nên không phải
+    parse lại DATA_FILE.
+    """
+    df = _data[_data['username']==username].copy()
+    df['address'] = df['address'].fillna('')
+    df['_day'] = pd.to_datetime(df['date'], errors='coerce')
+    df['_amount'] = pd.to_numeric(df['amount'], errors='coerce').fillna(0.0)
+    return df.reset_index(drop=True)
+
+def filter_user_frame(user_frame, addresses, start_date, end_date, keep_undated=False):
+    """
+    Lọc frame của get_user_frame() theo danh sách địa chỉ và khoảng ngày [start_date, end_date].
+    keep_undated=True giữ lại cả các dòng có ngày không đọc được (không thể xếp vào khoảng ngày).
+    """
+    df = user_frame[user_frame['address'].isin(list(addresses))]
+    mask = (df['_day'].dt.date >= start_date) & (df['_day'].dt.date <= end_date)
+    if keep_undated:
+        mask = mask | df['_day'].isna()
+    return df[mask]
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def get_chart_payload(_user_frame, username, addresses, start_date, end_date, resolution, version):
+    """
+    Trả về dict 2 DataFrame đã gom nhóm sẵn cho biểu đồ:
+    - 'activity': tổng Lít theo hoạt động (tối đa MAX_CHART_CATEGORIES cột, phần còn lại gộp vào 'Khác')
+    - 'timeline': tổng Lít theo kỳ ở độ phân giải `resolution` (tối đa MAX_CHART_POINTS điểm gần nhất)
+    Kết quả được cache theo (user, địa chỉ, khoảng ngày, độ phân giải, phiên bản dữ liệu).
+    """
+    df = filter_user_frame(_user_frame, addresses, start_date, end_date)
+    if df.empty:
+        return {
+            "activity": pd.DataFrame(columns=['activity','total_lit']),
+            "timeline": pd.DataFrame(columns=['label','amount']),
+        }
+
+    # backward-compatible: handle possible comma-separated activities
+    exploded = explode_and_allocate(df, activity_col='activity', amount_col='_amount')
+    act_sum = exploded.groupby('activity_list')['alloc_amount'].sum().reset_index().rename(columns={'activity_list':'activity','alloc_amount':'total_lit'})
+    act_sum = act_sum.sort_values('total_lit', ascending=False).reset_index(drop=True)
+    if len(act_sum) > MAX_CHART_CATEGORIES:
+        head = act_sum.iloc[:MAX_CHART_CATEGORIES-1]
+        rest = pd.DataFrame([{"activity": "Khác", "total_lit": act_sum.iloc[MAX_CHART_CATEGORIES-1:]['total_lit'].sum()}])
+        act_sum = pd.concat([head, rest], ignore_index=True)
+
+    freq = CHART_RESOLUTIONS[resolution][0]
+    period = df['_day'].dt.to_period(freq)
+    timeline = df.groupby(period)['_amount'].sum().sort_index().tail(MAX_CHART_POINTS)
+    if resolution == "week":
+        labels = [f"{p.start_time.isocalendar()[0]}-W{p.start_time.isocalendar()[1]:02d}" for p in timeline.index]
+    else:
+        labels = [str(p) for p in timeline.index]
+    timeline = pd.DataFrame({"label": labels, "amount": timeline.values})
+
+    return {"activity": act_sum, "timeline": timeline}
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def get_filtered_csv(_user_frame, username, addresses, start_date, end_date, version):
+    """
+    CSV của dữ liệu đã lọc theo địa chỉ + khoảng ngày (cache theo cùng key với biểu đồ, không phụ
+    thuộc độ phân giải). Các dòng được xuất nguyên trạng như trong DATA_FILE; dòng có ngày không
+    đọc được vẫn được giữ lại.
+    """
+    df = filter_user_frame(_user_frame, addresses, start_date, end_date, keep_undated=True)
+    return df.drop(columns=['_day','_amount']).to_csv(index=False)
+
+# ----------------- Leak / anomaly detector -----------------
+ANOMALY_Z = 3.0             # số độ lệch chuẩn so với baseline để coi là bất thường
+BASELINE_ALPHA = 0.1        # trọng số EWMA cho mean/variance (~ cửa sổ 20 mẫu gần nhất)
+MIN_BASELINE_SAMPLES = 5    # cần ít nhất n mẫu trước khi chấm điểm z
+LEAK_LIMIT_RATIO = 1.5      # tổng ngày vượt 1.5× daily_limit (cao hơn ngưỡng 1.1× của cây ảo)
+HEAVY_ENTRY_RATIO = 0.5     # 1 lần dùng >= 0.5× daily_limit được coi là "nặng"
+HEAVY_STREAK_DAYS = 3       # hoạt động nặng lặp lại >= 3 ngày liên tiếp
+MAX_ALERTS_PER_USER = 20
+STD_FLOOR_MEAN_RATIO = 0.5  # sàn std = 0.5× mean: cần vượt ~2.5× mức quen thuộc mới báo động
+STD_FLOOR_LIMIT_RATIO = 0.05  # và tối thiểu 5% daily_limit (10 L với ngưỡng 200 L)
+PARALLEL_MIN_ROWS = 50000   # dưới ngưỡng này chi phí khởi tạo process lớn hơn phần chấm điểm
+
+def _new_stat():
+    return {"n": 0, "mean": 0.0, "var": 0.0}
+
+def _ew_update(stat, x):
+    """Cập nhật mean/variance trượt (exponentially weighted) với O(1) bộ nhớ."""
+    if stat["n"] == 0:
+        stat["mean"], stat["var"] = x, 0.0
+    else:
+        diff = x - stat["mean"]
+        incr = BASELINE_ALPHA * diff
+        stat["mean"] += incr
+        stat["var"] = (1 - BASELINE_ALPHA) * (stat["var"] + diff * incr)
+    stat["n"] += 1
+
+def _z_score(stat, x, daily_limit):
+    """z-score của x so với baseline; None nếu baseline chưa đủ mẫu."""
+    if stat["n"] < MIN_BASELINE_SAMPLES:
+        return None
+    # form nhập điền sẵn lượng mặc định nên variance thường = 0: dùng sàn std theo mean và
+    # daily_limit để dao động bình thường giữa các ngày không bị coi là rò rỉ
+    std = max(stat["var"] ** 0.5, STD_FLOOR_MEAN_RATIO * abs(stat["mean"]), STD_FLOOR_LIMIT_RATIO * daily_limit, 1.0)
+    return (x - stat["mean"]) / std
+
+def _new_user_state():
+    return {
+        "activities": {},   # activity -> {n, mean, var, heavy_date, streak}
+        "daily": _new_stat(),
+        "day": None,        # ngày đang cộng dồn (YYYY-MM-DD)
+        "day_total": 0.0,
+        "day_flags": [],    # loại cảnh báo ngày đã phát cho "day" (tránh lặp)
+        "alerts": [],
+    }
+
+def _score_entry(state, entry, daily_limit, day_total=None):
+    """
+    Cập nhật state của 1 user với 1 entry (dict giống 1 dòng DATA_FILE) và trả về
+    danh sách cảnh báo mới. Entry có ngày cũ hơn ngày đang cộng dồn (nhập lùi ngày) không
+    làm thay đổi baseline ngày; nếu có day_total (tổng của ngày đó, đã gồm entry) thì vẫn
+    kiểm tra daily_spike/over_limit cho ngày đó.
+    Bỏ qua entry có amount không hợp lệ, NaN/inf hoặc âm, hoặc có ngày không theo dạng
+    YYYY-MM-DD (vd. ô ngày bị xóa trong editor), để không làm hỏng baseline.
+    """
+    alerts = []
+    try:
+        amount = float(entry.get("amount", 0))
+    except (TypeError, ValueError):
+        return alerts
+    if not math.isfinite(amount) or amount < 0:
+        return alerts
+    try:
+        day = datetime.strptime(str(entry.get("date", ""))[:10], "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return alerts
+    activity = str(entry.get("activity", "") or "Không xác định")
+    daily_limit = float(daily_limit) if daily_limit else 200.0
+
+    def _alert(kind, expected, message, total=None):
+        # total: tổng ngày cho cảnh báo cấp ngày (daily_spike/over_limit), None cho cấp lần nhập
+        alerts.append({
+            "username": entry.get("username", ""),
+            "date": day,
+            "time": entry.get("time", ""),
+            "kind": kind,
+            "activity": activity,
+            "amount": round(amount, 2),
+            "day_total": round(total, 2) if total is not None else None,
+            "expected": round(expected, 2),
+            "message": message,
+        })
+
+    # --- theo hoạt động ---
+    act = state["activities"].setdefault(activity, dict(_new_stat(), heavy_date=None, streak=0))
+    z = _z_score(act, amount, daily_limit)
+    if z is not None and z > ANOMALY_Z:
+        _alert("activity_spike", act["mean"], f"{activity}: {amount:.1f} L, cao bất thường so với mức quen thuộc ~{act['mean']:.1f} L")
+    _ew_update(act, amount)
+
+    # chuỗi ngày liên tiếp có lần dùng "nặng" cho hoạt động này
+    heavy_date = act["heavy_date"]
+    if amount >= HEAVY_ENTRY_RATIO * daily_limit and (heavy_date is None or day > heavy_date):
+        try:
+            consecutive = heavy_date is not None and (pd.Timestamp(day) - pd.Timestamp(heavy_date)).days == 1
+        except ValueError:
+            consecutive = False
+        act["streak"] = act["streak"] + 1 if consecutive else 1
+        act["heavy_date"] = day
+        # chỉ báo 1 lần cho mỗi chuỗi để không đẩy các cảnh báo khác ra khỏi bộ đệm
+        if act["streak"] == HEAVY_STREAK_DAYS:
+            _alert("heavy_streak", HEAVY_ENTRY_RATIO * daily_limit, f"{activity} ({amount:.0f} L) lặp lại {act['streak']} ngày liên tiếp")
+
+    # --- theo ngày ---
+    if state["day"] is not None and day < state["day"]:
+        # nhập lùi ngày: chỉ báo khi chính entry này làm tổng ngày vượt ngưỡng,
+        # giống kết quả batch mode (dữ liệu được sắp theo ngày)
+        if day_total is not None and math.isfinite(day_total):
+            before = day_total - amount
+            z_now, z_before = _z_score(state["daily"], day_total, daily_limit), _z_score(state["daily"], before, daily_limit)
+            if z_now is not None and z_now > ANOMALY_Z and z_before <= ANOMALY_Z:
+                _alert("daily_spike", state["daily"]["mean"], f"Tổng ngày {day_total:.1f} L, cao bất thường so với trung bình ~{state['daily']['mean']:.1f} L/ngày", day_total)
+            if day_total > LEAK_LIMIT_RATIO * daily_limit >= before:
+                _alert("over_limit", daily_limit, f"Tổng ngày {day_total:.1f} L, vượt {LEAK_LIMIT_RATIO}× ngưỡng {daily_limit:.0f} L — kiểm tra rò rỉ?", day_total)
+    elif state["day"] is None or day > state["day"]:
+        if state["day"] is not None:
+            _ew_update(state["daily"], state["day_total"])
+        state["day"], state["day_total"], state["day_flags"] = day, 0.0, []
+    if day == state["day"]:
+        state["day_total"] += amount
+        total = state["day_total"]
+        z = _z_score(state["daily"], total, daily_limit)
+        if z is not None and z > ANOMALY_Z and "daily_spike" not in state["day_flags"]:
+            state["day_flags"].append("daily_spike")
+            _alert("daily_spike", state["daily"]["mean"], f"Tổng ngày {total:.1f} L, cao bất thường so với trung bình ~{state['daily']['mean']:.1f} L/ngày", total)
+        if total > LEAK_LIMIT_RATIO * daily_limit and "over_limit" not in state["day_flags"]:
+            state["day_flags"].append("over_limit")
+            _alert("over_limit", daily_limit, f"Tổng ngày {total:.1f} L, vượt {LEAK_LIMIT_RATIO}× ngưỡng {daily_limit:.0f} L — kiểm tra rò rỉ?", total)
+
+    state["alerts"] = (state["alerts"] + alerts)[-MAX_ALERTS_PER_USER:]
+    return alerts
+
+def _score_user_history(args):
+    """Worker cho batch mode: chấm toàn bộ lịch sử của 1 user từ state rỗng."""
+    username, records, daily_limit = args
+    state = _new_user_state()
+    alerts = []
+    for entry in records:
+        alerts.extend(_score_entry(state, entry, daily_limit))
+    return username, state, alerts
+
+def score_usage_dataset(data, users, workers=1):
+    """
+    Chấm toàn bộ dữ liệu theo từng user (state của mỗi user độc lập).
+    Trả về (states theo user, DataFrame cảnh báo).
+    Mặc định chạy tuần tự; chỉ dùng process pool khi workers > 1 và dữ liệu có ít nhất
+    PARALLEL_MIN_ROWS dòng. Nếu hệ thống không tạo được process (OSError/NotImplementedError)
+    thì quay về chạy tuần tự; lỗi của worker (vd. BrokenProcessPool) được ném ra ngoài.
+    """
+    alert_cols = ["username","date","time","kind","activity","amount","day_total","expected","message"]
+    if data.empty:
+        return {}, pd.DataFrame(columns=alert_cols)
+
+    limits = {}
+    if not users.empty and "daily_limit" in users.columns:
+        limits = pd.to_numeric(users.set_index("username")["daily_limit"], errors="coerce").dropna().to_dict()
+
+    ordered = data.sort_values(["date","time"], kind="stable")
+    jobs = [
+        (username, group[["username","date","time","activity","amount"]].to_dict("records"), limits.get(username, 200))
+        for username, group in ordered.groupby("username", sort=False)
+    ]
+
+    workers = workers or os.cpu_count() or 1
+    results = None
+    if workers > 1 and len(jobs) > 1 and len(data) >= PARALLEL_MIN_ROWS:
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+                results = list(pool.map(_score_user_history, jobs, chunksize=max(len(jobs) // (workers * 4), 1)))
+        except (OSError, NotImplementedError):
+            results = None
+    if results is None:
+        results = [_score_user_history(job) for job in jobs]
+
+    states = {username: state for username, state, _ in results}
+    alerts = [a for _, _, user_alerts in results for a in user_alerts]
+    return states, pd.DataFrame(alerts, columns=alert_cols)
+
+def score_all_households(workers=None):
+    """
+    Batch mode: chấm toàn bộ DATA_FILE song song trên mọi core, trả về DataFrame cảnh báo.
+    Dùng cho job offline, không gọi trong lúc Streamlit đang render trang, vd:
+        python -c "import water_loop_conservation as w; print(w.score_all_households())"
+    """
+    _, alerts = score_usage_dataset(load_data(), load_users(), workers=workers or os.cpu_count() or 1)
+    return alerts
+
+class UsageAnomalyDetector:
+    """
+    Detector streaming: giữ baseline O(1) cho mỗi user (mean/variance trượt theo hoạt động
+    và theo ngày), cập nhật từng entry mới thay vì tính lại từ toàn bộ lịch sử.
+    """
+    def __init__(self, states=None):
+        self.states = states or {}
+        self._lock = threading.Lock()
+
+    def update(self, entry, daily_limit=None, day_total=None):
+        """
+        Chấm điểm + cập nhật baseline với 1 entry mới, trả về danh sách cảnh báo mới.
+        day_total: tổng Lít của ngày entry (đã gồm entry), dùng khi entry được nhập lùi ngày.
+        """
+        with self._lock:
+            state = self.states.setdefault(entry.get("username", ""), _new_user_state())
+            return _score_entry(state, entry, daily_limit, day_total)
+
+    def recent_alerts(self, username):
+        with self._lock:
+            state = self.states.get(username)
+            return list(state["alerts"]) if state else []
+
+@st.cache_resource(show_spinner=False)
+def get_anomaly_detector():
+    """
+    Detector dùng chung cho mọi session, khởi tạo 1 lần (tuần tự, trong tiến trình) từ dữ liệu hiện có.
+    Gọi get_anomaly_detector.clear() sau khi sửa/xóa dữ liệu cũ để dựng lại baseline.
+    """
+    states, _ = score_usage_dataset(load_data(), load_users(), workers=1)
+    return UsageAnomalyDetector(states)
+
 # ----------------- UI: Grouped log view -----------------
 def show_grouped_log_for_user(data, username):
     """
@@ -382,6 +716,12 @@ def show_grouped_log_for_user(data, username):
     # sort by date/time descending
     grouped = grouped.sort_values(['date','time'], ascending=[False,False]).reset_index(drop=True)
 
+    # paginate so only GROUP_LOG_PAGE_SIZE groups are sent to the browser per rerun
+    n_pages = max((len(grouped) - 1) // GROUP_LOG_PAGE_SIZE + 1, 1)
+    if n_pages > 1:
+        page = st.number_input(f"Trang (1–{n_pages})", min_value=1, max_value=n_pages, value=1, step=1)
+        grouped = grouped.iloc[(page-1)*GROUP_LOG_PAGE_SIZE : page*GROUP_LOG_PAGE_SIZE].reset_index(drop=True)
+
     # show grouped summary table (user-friendly columns)
     st.dataframe(grouped[['group_id','date','time','address','total_amount','activities']].rename(
         columns={'total_amount':'Tổng Lít','activities':'Hoạt động'}), use_container_width=True)
@@ -432,6 +772,7 @@ def show_grouped_log_for_user(data, username):
                         data.at[orig_idx, 'note'] = row.get('note', data.at[orig_idx, 'note'])
                         data.at[orig_idx, 'address'] = row.get('address', data.at[orig_idx, 'address'])
                     save_data(data)
+                    get_anomaly_detector.clear()
                     st.success("✅ Lưu thay đổi thành công.")
                     safe_rerun()
             except Exception as e:
@@ -447,6 +788,7 @@ def show_grouped_log_for_user(data, username):
                 indices_to_drop = [orig_indices[pos] for pos in to_delete]
                 data = data.drop(indices_to_drop).reset_index(drop=True)
                 save_data(data)
+                get_anomaly_detector.clear()
                 st.success(f"✅ Đã xóa {len(indices_to_drop)} hoạt động.")
                 safe_rerun()
 
@@ -454,6 +796,7 @@ def show_grouped_log_for_user(data, username):
         if st.button("🗑️ Xóa toàn bộ nhóm này"):
             data = data[data['group_id'] != sel].reset_index(drop=True)
             save_data(data)
+            get_anomaly_detector.clear()
             st.success("✅ Đã xóa toàn bộ nhóm.")
             safe_rerun()
 
@@ -471,6 +814,8 @@ def water_dashboard():
 
     # load users & data
     users = load_users()
+    # lấy version trước khi đọc file: nếu file đổi giữa 2 bước thì lần rerun sau sẽ có key mới
+    version = data_version()
     data = load_data()
     data = ensure_group_ids(data)  # backfill group ids if missing
 
@@ -532,7 +877,8 @@ def water_dashboard():
             if not activity:
                 st.warning("Vui lòng chọn hoặc nhập hoạt động.")
             else:
-                data = save_or_merge_entry(data, username, house_type, location, addr_input, activity, amount, note_quick, date_input)
+                data = save_or_merge_entry(data, username, house_type, location, addr_input, activity, amount, note_quick, date_input,
+                                           detector=get_anomaly_detector(), daily_limit=daily_limit)
                 save_data(data)
                 st.success("✅ Đã lưu hoạt động!")
                 safe_rerun()
@@ -558,28 +904,42 @@ def water_dashboard():
 
     # Filters and Charts
     st.subheader("🔍 Bộ lọc & Biểu đồ")
-    user_data_all = data[data['username']==username].copy()
+    user_data_all = data[data['username']==username]
     if not user_data_all.empty:
-        user_data_all['datetime'] = pd.to_datetime(user_data_all['date'].astype(str) + " " + user_data_all['time'].astype(str), errors='coerce')
-        try:
-            if user_data_all['datetime'].dt.tz is None:
-                user_data_all['datetime'] = user_data_all['datetime'].dt.tz_localize("Asia/Ho_Chi_Minh", ambiguous="NaT", nonexistent="shift_forward")
-        except Exception:
-            user_data_all['datetime'] = localize_series_to_vn(user_data_all['datetime'])
-
         all_addresses = user_data_all['address'].fillna('').unique().tolist()
         selected_addresses = st.multiselect("Chọn địa chỉ để phân tích", options=all_addresses, default=all_addresses)
-        filtered_data = user_data_all[user_data_all['address'].isin(selected_addresses)].copy()
+        addresses_key = tuple(sorted(selected_addresses))
+
+        all_days = pd.to_datetime(user_data_all['date'], errors='coerce').dropna()
+        first_day = all_days.min().date() if not all_days.empty else now_vietnam().date()
+        last_day = max(all_days.max().date(), now_vietnam().date()) if not all_days.empty else now_vietnam().date()
+        date_range = st.date_input("📅 Khoảng ngày phân tích", value=(first_day, last_day), min_value=first_day, max_value=last_day)
+        # date_input trả về tuple 1 phần tử khi người dùng mới chọn ngày bắt đầu
+        if isinstance(date_range, (list, tuple)):
+            start_date = date_range[0] if len(date_range) > 0 else first_day
+            end_date = date_range[1] if len(date_range) > 1 else start_date
+        else:
+            start_date = end_date = date_range
+
+        auto_resolution = pick_chart_resolution(start_date, end_date)
+        resolution_options = ["auto"] + list(CHART_RESOLUTIONS.keys())
+        # key cố định + nhãn không đổi để lựa chọn thủ công không bị reset khi khoảng ngày thay đổi
+        resolution_choice = st.radio(
+            "Độ phân giải tổng kết", resolution_options, horizontal=True, key="chart_resolution",
+            format_func=lambda r: "Tự động" if r == "auto" else CHART_RESOLUTIONS[r][1]
+        )
+        if resolution_choice == "auto":
+            st.caption(f"Tự động chọn theo khoảng ngày: {CHART_RESOLUTIONS[auto_resolution][1].lower()}")
+        resolution = auto_resolution if resolution_choice == "auto" else resolution_choice
+        resolution_label = CHART_RESOLUTIONS[resolution][1]
 
-        time_frame = st.radio("Khoảng thời gian tổng kết", ["Tuần","Tháng"], horizontal=True)
+        user_frame = get_user_frame(data, username, version)
+        payload = get_chart_payload(user_frame, username, addresses_key, start_date, end_date, resolution, version)
 
         # Activity bar chart (no need to allocate since each row is single activity)
         st.markdown("**📊 Biểu đồ theo hoạt động (tổng Lít)**")
-        if not filtered_data.empty:
-            # backward-compatible: handle possible comma-separated activities
-            exploded = explode_and_allocate(filtered_data, activity_col='activity', amount_col='amount')
-            act_sum = exploded.groupby('activity_list')['alloc_amount'].sum().reset_index().rename(columns={'activity_list':'activity','alloc_amount':'total_lit'})
-            act_sum = act_sum.sort_values('total_lit', ascending=False)
+        act_sum = payload["activity"]
+        if not act_sum.empty:
             chart1 = alt.Chart(act_sum).mark_bar().encode(
                 x=alt.X('activity:N', sort='-y', title='Hoạt động'),
                 y=alt.Y('total_lit:Q', title='Tổng Lít'),
@@ -591,32 +951,21 @@ def water_dashboard():
             st.info("Chưa có dữ liệu cho bộ lọc hiện tại.")
 
         st.markdown("---")
-        # Week/Month totals
-        st.markdown("**📈 Tổng lượng theo khoảng (Tuần/Tháng)**")
-        if not filtered_data.empty:
-            if time_frame == 'Tuần':
-                filtered_data['year'] = filtered_data['datetime'].dt.isocalendar().year
-                filtered_data['week'] = filtered_data['datetime'].dt.isocalendar().week
-                week_sum = filtered_data.groupby(['year','week'])['amount'].sum().reset_index()
-                week_sum['label'] = week_sum['year'].astype(str) + '-W' + week_sum['week'].astype(str)
-                chart2 = alt.Chart(week_sum).mark_bar().encode(
-                    x=alt.X('label:N', sort='-y', title='Tuần'),
-                    y=alt.Y('amount:Q', title='Tổng Lít'),
-                    tooltip=['label','amount']
-                ).properties(height=240)
-                st.altair_chart(chart2, use_container_width=True)
-            else:
-                filtered_data['month'] = filtered_data['datetime'].dt.to_period('M').astype(str)
-                month_sum = filtered_data.groupby('month')['amount'].sum().reset_index()
-                chart2 = alt.Chart(month_sum).mark_bar().encode(
-                    x=alt.X('month:N', sort='-y', title='Tháng'),
-                    y=alt.Y('amount:Q', title='Tổng Lít'),
-                    tooltip=['month','amount']
-                ).properties(height=240)
-                st.altair_chart(chart2, use_container_width=True)
+        # Totals per period at the selected resolution
+        st.markdown(f"**📈 Tổng lượng theo {resolution_label.lower()}**")
+        timeline = payload["timeline"]
+        if not timeline.empty:
+            chart2 = alt.Chart(timeline).mark_bar().encode(
+                x=alt.X('label:N', sort=None, title=resolution_label),
+                y=alt.Y('amount:Q', title='Tổng Lít'),
+                tooltip=['label','amount']
+            ).properties(height=240)
+            st.altair_chart(chart2, use_container_width=True)
+            if len(timeline) >= MAX_CHART_POINTS:
+                st.caption(f"Chỉ hiển thị {MAX_CHART_POINTS} {resolution_label.lower()} gần nhất.")
 
         # download filtered csv
-        st.download_button("📥 Tải dữ liệu phân tích (CSV)", filtered_data.to_csv(index=False), "water_usage_filtered.csv", "text/csv")
+        st.download_button("📥 Tải dữ liệu phân tích (CSV)", get_filtered_csv(user_frame, username, addresses_key, start_date, end_date, version), "water_usage_filtered.csv", "text/csv")
     else:
         st.info("Chưa có dữ liệu để hiển thị biểu đồ. Hãy nhập hoạt động trước.")
 
@@ -640,6 +989,20 @@ def water_dashboard():
     st.markdown(f"<div style='font-size:60px;text-align:center'>{pet_emoji}</div>", unsafe_allow_html=True)
     st.markdown(f"<div style='padding:14px;border-radius:12px;background:{pet_color};color:white;font-weight:bold;text-align:center;font-size:18px;'>{pet_msg}</div>", unsafe_allow_html=True)
 
+    # Leak / anomaly alerts
+    st.markdown("---")
+    st.subheader("🚨 Cảnh báo rò rỉ / bất thường")
+    alerts = get_anomaly_detector().recent_alerts(username)
+    if alerts:
+        today_str = now_vietnam().strftime("%Y-%m-%d")
+        for a in [a for a in alerts if a["date"] == today_str]:
+            st.warning(f"⚠️ {a['message']}")
+        with st.expander(f"Các cảnh báo gần đây ({len(alerts)})"):
+            st.dataframe(pd.DataFrame(alerts[::-1]).reindex(columns=['date','time','activity','amount','day_total','expected','message']).rename(
+                columns={'amount':'Lít (lần nhập)','day_total':'Tổng ngày (L)','expected':'Mức tham chiếu','message':'Cảnh báo'}), use_container_width=True, hide_index=True)
+    else:
+        st.write("Chưa phát hiện bất thường nào. 💧")
+
     # Logout
     if st.button("🚪 Đăng xuất", use_container_width=True):
         st.session_state.logged_in=False